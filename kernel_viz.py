@@ -1,15 +1,34 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Tuple
+from typing import Any, Callable, Dict, Tuple
 
 import re
 import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-from graphviz import Digraph
+from graphviz import Digraph, ExecutableNotFound
+
+
+_NAME_TOKEN_RE = re.compile(r"([A-Za-z_]+)\(([^)]+)\)")
+_TRAIL_DIGITS_RE = re.compile(r"(\d+)$")
+_STRIP_DIGITS_RE = re.compile(r"\d+$")
+_NULL_TOKENS = frozenset({"none", "null", "nil"})
+_PRETTY_MAP = {
+    "rbf": "RBF",
+    "per": "Per",
+    "periodic": "Per",
+    "lin": "Lin",
+    "linear": "Lin",
+    "wn": "WN",
+    "white": "WN",
+}
+# Like graphviz's quoting: escape only quotes so \n-style escapes pass through.
+_DOT_ESCAPE = str.maketrans({'"': '\\"'})
 
 
 def _split_name_token(token: str) -> tuple[str, str | None]:
-    m = re.match(r"([A-Za-z_]+)\(([^)]+)\)", token)
+    m = _NAME_TOKEN_RE.match(token)
     if m:
         return m.group(1), m.group(2)
     return token, None
@@ -18,7 +37,7 @@ def _split_name_token(token: str) -> tuple[str, str | None]:
 def _shorten_id(text: str | None) -> str | None:
     if not text:
         return text
-    m = re.search(r"(\d+)$", text)
+    m = _TRAIL_DIGITS_RE.search(text)
     if m:
         return text[: max(0, len(text) - len(m.group(1)))] + m.group(1)[-2:]
     return text
@@ -26,32 +45,57 @@ def _shorten_id(text: str | None) -> str | None:
 
 def _pretty_kernel_token(token: str) -> str:
     token = token.strip()
-    if token.lower() in {"none", "null", "nil"}:
+    if token.lower() in _NULL_TOKENS:
         return "X"
-    base = re.sub(r"\d+$", "", token).lower()
-    mapping = {
-        "rbf": "RBF",
-        "per": "Per",
-        "periodic": "Per",
-        "lin": "Lin",
-        "linear": "Lin",
-        "wn": "WN",
-        "white": "WN",
-    }
-    if base in mapping:
-        return mapping[base]
-    return re.sub(r"\d+$", "", token)
+    stripped = _STRIP_DIGITS_RE.sub("", token)
+    pretty = _PRETTY_MAP.get(stripped.lower())
+    if pretty is not None:
+        return pretty
+    return stripped
+
+
+_LABEL_CACHE_MAX = 16384
+# id(node) -> (node, label). Holding the node keeps its id from being reused
+# while the entry is alive, so an id hit always refers to the same object.
+_label_cache: Dict[int, Tuple[Any, str]] = {}
+_LABEL_DISPATCH: Dict[type, Callable[[Any], str]] = {}
 
 
 def _get_label(node: Any) -> str:
+    hit = _label_cache.get(id(node))
+    if hit is not None:
+        return hit[1]
+    label = _compute_label(node)
+    if len(_label_cache) >= _LABEL_CACHE_MAX:
+        _label_cache.clear()
+    _label_cache[id(node)] = (node, label)
+    return label
+
+
+def _compute_label(node: Any) -> str:
+    cls = type(node)
+    label_fn = _LABEL_DISPATCH.get(cls)
+    if label_fn is None:
+        # Matched by name so kernel_viz need not import visualize_log_run.
+        label_fn = _kernel_node_label if cls.__name__ == "KernelNode" else _generic_label
+        _LABEL_DISPATCH[cls] = label_fn
+    return label_fn(node)
+
+
+def _kernel_node_label(node: Any) -> str:
+    op = getattr(node, "op", None)
+    if op is not None:
+        return str(op)
+    name = getattr(node, "name", None)
+    if not name or str(name).lower() in _NULL_TOKENS:
+        return "X"
+    base, _detail = _split_name_token(str(name))
+    return _pretty_kernel_token(base)
+
+
+def _generic_label(node: Any) -> str:
     if hasattr(node, "op") and getattr(node, "op") is not None:
         return str(getattr(node, "op"))
-    if node.__class__.__name__ == "KernelNode":
-        name = getattr(node, "name", None)
-        if not name or str(name).lower() in {"none", "null", "nil"}:
-            return "X"
-        base, _detail = _split_name_token(str(name))
-        return _pretty_kernel_token(base)
     if hasattr(node, "name"):
         type_name = node.__class__.__name__
         name = _shorten_id(getattr(node, "name", None))
@@ -83,30 +127,44 @@ def _is_binary(node: Any) -> bool:
     return hasattr(node, "left") and hasattr(node, "right")
 
 
+def _emit_tree(
+    graph: Digraph,
+    node: Any,
+    id_prefix: str,
+    highlight_map: Dict[Tuple[str, ...], str] | None,
+    base_fillcolor: str,
+) -> Dict[Tuple[str, ...], str]:
+    path_to_id: Dict[Tuple[str, ...], str] = {}
+    parts: list[str] = []
+
+    stack: list[tuple[Any, Tuple[str, ...], str | None, str | None]] = [(node, (), None, None)]
+    while stack:
+        n, path, parent, edge_label = stack.pop()
+        node_id = f"{id_prefix}{len(path_to_id)}"
+        path_to_id[path] = node_id
+        label = _get_label(n).translate(_DOT_ESCAPE)
+        fill = highlight_map.get(path, base_fillcolor) if highlight_map else base_fillcolor
+        parts.append(f'\t{node_id} [label="{label}" fillcolor="{fill}"]\n')
+        if parent is not None:
+            parts.append(f'\t{parent} -> {node_id} [label="{edge_label or ""}"]\n')
+        if _is_binary(n):
+            stack.append((n.right, path + ("R",), node_id, "R"))
+            stack.append((n.left, path + ("L",), node_id, "L"))
+
+    graph.body.extend(parts)
+    return path_to_id
+
+
 def _build_graph(
     node: Any,
     *,
     base_fillcolor: str = "#ffffff",
-) -> Tuple[Digraph, Dict[int, Tuple[str, ...]], Dict[int, str]]:
+    highlight_map: Dict[Tuple[str, ...], str] | None = None,
+) -> Tuple[Digraph, Dict[Tuple[str, ...], str]]:
     graph = Digraph("kernel")
     graph.attr("node", shape="box", style="rounded,filled", fontname="Helvetica")
-    paths: Dict[int, Tuple[str, ...]] = {}
-    labels: Dict[int, str] = {}
-
-    def rec(n: Any, path: Tuple[str, ...], parent: int | None, edge_label: str | None) -> int:
-        node_id = len(paths)
-        paths[node_id] = path
-        labels[node_id] = _get_label(n)
-        graph.node(str(node_id), labels[node_id], fillcolor=base_fillcolor)
-        if parent is not None:
-            graph.edge(str(parent), str(node_id), label=edge_label or "")
-        if _is_binary(n):
-            rec(n.left, path + ("L",), node_id, "L")
-            rec(n.right, path + ("R",), node_id, "R")
-        return node_id
-
-    rec(node, (), None, None)
-    return graph, paths, labels
+    path_to_id = _emit_tree(graph, node, "", highlight_map, base_fillcolor)
+    return graph, path_to_id
 
 
 def _add_kernel_to_graph(
@@ -116,27 +174,52 @@ def _add_kernel_to_graph(
     highlight_paths: Dict[Tuple[str, ...], str] | None,
     *,
     base_fillcolor: str = "#ffffff",
-) -> Tuple[str, Dict[str, Tuple[str, ...]], Dict[str, str]]:
-    paths: Dict[str, Tuple[str, ...]] = {}
-    labels: Dict[str, str] = {}
-
-    def rec(n: Any, path: Tuple[str, ...], parent: str | None, edge_label: str | None) -> str:
-        node_id = f"{prefix}_{len(paths)}"
-        paths[node_id] = path
-        labels[node_id] = _get_label(n)
-        fill = base_fillcolor
-        if highlight_paths:
-            fill = highlight_paths.get(path, base_fillcolor)
-        graph.node(node_id, labels[node_id], fillcolor=fill)
-        if parent is not None:
-            graph.edge(parent, node_id, label=edge_label or "")
-        if _is_binary(n):
-            rec(n.left, path + ("L",), node_id, "L")
-            rec(n.right, path + ("R",), node_id, "R")
-        return node_id
-
-    root_id = rec(node, (), None, None)
-    return root_id, paths, labels
+) -> Tuple[str, Dict[Tuple[str, ...], str]]:
+    path_to_id = _emit_tree(graph, node, f"{prefix}_", highlight_paths, base_fillcolor)
+    return f"{prefix}_0", path_to_id
+
+
+class DotBatch:
+    """Queue graphs and render them to PNG with ``dot -Tpng -O`` on flush()."""
+
+    def __init__(self, *, max_files: int = 256, max_workers: int | None = None) -> None:
+        self.max_files = max_files
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pending: Dict[str, str] = {}
+
+    def add(self, graph: Digraph, base: str) -> None:
+        self._pending[base] = graph.source
+
+    def flush(self) -> None:
+        queued, self._pending = self._pending, {}
+        if not queued:
+            return
+        for base, source in queued.items():
+            with open(base, "w", encoding="utf-8") as f:
+                f.write(source)
+        pending = list(queued)
+        n_chunks = max(-(-len(pending) // self.max_files), min(self.max_workers, len(pending)))
+        chunks = [pending[i::n_chunks] for i in range(n_chunks)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+            list(ex.map(_run_dot, chunks))
+        for base in pending:
+            os.remove(base)
+
+
+def _run_dot(sources: list[str]) -> None:
+    cmd = ["dot", "-Tpng", "-O", *sources]
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    except FileNotFoundError as e:
+        raise ExecutableNotFound(cmd) from e
+
+
+def _render_png(graph: Digraph, save_path: str, batch: DotBatch | None) -> None:
+    base, _ = os.path.splitext(save_path)
+    if batch is not None:
+        batch.add(graph, base)
+    else:
+        graph.render(base, format="png", cleanup=True)
 
 
 def render_kernel_graph(
@@ -149,28 +232,22 @@ def render_kernel_graph(
     score: float | None = None,
     title: str | None = None,
     save_path: str | None = None,
+    batch: DotBatch | None = None,
 ) -> None:
-    graph, paths, labels = _build_graph(kernel, base_fillcolor=base_fillcolor)
-
     highlight_map: Dict[Tuple[str, ...], str] = {}
     if highlight_paths:
         highlight_map.update(highlight_paths)
     elif highlight_path is not None:
         highlight_map[highlight_path] = highlight_color
 
-    if highlight_map:
-        for node_id, path in paths.items():
-            color = highlight_map.get(path)
-            if color:
-                graph.node(str(node_id), labels[node_id], fillcolor=color)
+    graph, _ = _build_graph(kernel, base_fillcolor=base_fillcolor, highlight_map=highlight_map)
 
     if title or score is not None:
         score_txt = f" | score={score:.3f}" if score is not None else ""
         graph.attr(label=f"{title or 'Kernel'}{score_txt}", labelloc="t")
 
     if save_path:
-        base, _ = os.path.splitext(save_path)
-        graph.render(base, format="png", cleanup=True)
+        _render_png(graph, save_path, batch)
 
 
 def render_kernel_chain(
@@ -179,6 +256,7 @@ def render_kernel_chain(
     *,
     title: str,
     save_path: str,
+    batch: DotBatch | None = None,
 ) -> None:
     graph = Digraph("kernel_chain")
     graph.attr("node", shape="box", style="rounded,filled", fontname="Helvetica")
@@ -189,7 +267,7 @@ def render_kernel_chain(
         prefix = f"k{idx}"
         with graph.subgraph(name=f"cluster_{prefix}") as sub:
             sub.attr(rankdir="TB")
-            root_id, _, _ = _add_kernel_to_graph(sub, k, prefix, None, base_fillcolor="#ffffff")
+            root_id, _ = _add_kernel_to_graph(sub, k, prefix, None, base_fillcolor="#ffffff")
         score_txt = "" if scores[idx] is None else f"{scores[idx]:.3f}"
         graph.node(f"{prefix}_label", f"Step {idx}\nscore={score_txt}", shape="note", fillcolor="#f8f8f8")
         graph.edge(f"{prefix}_label", root_id, style="dashed")
@@ -204,8 +282,7 @@ def render_kernel_chain(
         graph.edge(roots[i], roots[i + 1], style="bold", color="#666666")
 
     graph.attr(label=title, labelloc="t")
-    base, _ = os.path.splitext(save_path)
-    graph.render(base, format="png", cleanup=True)
+    _render_png(graph, save_path, batch)
 
 
 def render_kernel_mutation(
@@ -216,17 +293,18 @@ def render_kernel_mutation(
     score: float | None,
     title: str,
     save_path: str,
+    batch: DotBatch | None = None,
 ) -> None:
     graph = Digraph("kernel_mutation")
     graph.attr("node", shape="box", style="rounded,filled", fontname="Helvetica")
     graph.attr(rankdir="LR")
 
-    before_paths: Dict[str, Tuple[str, ...]] = {}
-    after_paths: Dict[str, Tuple[str, ...]] = {}
+    before_path_to_id: Dict[Tuple[str, ...], str] = {}
+    after_path_to_id: Dict[Tuple[str, ...], str] = {}
 
     with graph.subgraph(name="cluster_before") as sub:
         sub.attr(label="Before", color="#dddddd")
-        _, before_paths, _ = _add_kernel_to_graph(
+        _, before_path_to_id = _add_kernel_to_graph(
             sub,
             before,
             "b",
@@ -236,7 +314,7 @@ def render_kernel_mutation(
 
     with graph.subgraph(name="cluster_after") as sub:
         sub.attr(label="After", color="#dddddd")
-        _, after_paths, _ = _add_kernel_to_graph(
+        _, after_path_to_id = _add_kernel_to_graph(
             sub,
             after,
             "a",
@@ -245,12 +323,11 @@ def render_kernel_mutation(
         )
 
     if sever_path is not None:
-        before_id = next((k for k, v in before_paths.items() if v == sever_path), None)
-        after_id = next((k for k, v in after_paths.items() if v == sever_path), None)
+        before_id = before_path_to_id.get(sever_path)
+        after_id = after_path_to_id.get(sever_path)
         if before_id and after_id:
             graph.edge(before_id, after_id, style="dashed", color="#999999")
 
     score_txt = f" | score={score:.3f}" if score is not None else ""
     graph.attr(label=f"{title}{score_txt}", labelloc="t")
-    base, _ = os.path.splitext(save_path)
-    graph.render(base, format="png", cleanup=True)
+    _render_png(graph, save_path, batch)
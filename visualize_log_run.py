@@ -1,18 +1,21 @@
 from __future__ import annotations
 
-import io
 import os
 import re
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from functools import lru_cache
+from typing import Dict, Iterator, List, Tuple
 
-import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
 from PIL import Image
 
-from kernel_viz import render_kernel_chain, render_kernel_graph, render_kernel_mutation
+from kernel_viz import DotBatch, render_kernel_chain, render_kernel_graph, render_kernel_mutation
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class KernelNode:
     name: str | None = None
     op: str | None = None
@@ -29,57 +32,82 @@ def _strip_highlight(s: str) -> str:
     return s.replace("[[", "").replace("]]", "").strip()
 
 
-def _skip_ws(s: str, i: int) -> int:
-    while i < len(s) and s[i].isspace():
-        i += 1
-    return i
-
-
-def _parse_base(s: str, i: int) -> tuple[KernelNode, int]:
-    start = i
-    while i < len(s) and s[i] not in [" ", ")", "+", "*"]:
-        if s[i] == "(":
-            break
-        i += 1
-    if i < len(s) and s[i] == "(":
-        depth = 0
-        while i < len(s):
-            if s[i] == "(":
-                depth += 1
-            elif s[i] == ")":
-                depth -= 1
-                if depth == 0:
-                    i += 1
-                    break
+_OPERATORS = frozenset("+*")
+
+
+def _tokenize(s: str) -> list[tuple[str, str]]:
+    tokens: list[tuple[str, str]] = []
+    i, n = 0, len(s)
+    while i < n:
+        c = s[i]
+        if c.isspace():
+            i += 1
+        elif c == "(" or c == ")":
+            tokens.append((c, c))
             i += 1
-    token = s[start:i].strip()
-    if not token:
-        return KernelNode(name="X"), min(i + 1, len(s))
-    return KernelNode(name=token), i
-
-
-def _parse_expr(s: str, i: int = 0) -> tuple[KernelNode, int]:
-    i = _skip_ws(s, i)
-    if i >= len(s):
-        return KernelNode(name="?"), i
-    if s[i] == "(":
-        i += 1
-        left, i = _parse_expr(s, i)
-        i = _skip_ws(s, i)
-        op = s[i]
-        i += 1
-        right, i = _parse_expr(s, i)
-        i = _skip_ws(s, i)
-        if i < len(s) and s[i] == ")":
+        elif c in _OPERATORS:
+            tokens.append(("op", c))
             i += 1
-        return KernelNode(op=op, left=left, right=right), i
-    return _parse_base(s, i)
+        else:
+            start = i
+            while i < n and not s[i].isspace() and s[i] not in "()+*":
+                i += 1
+            if i < n and s[i] == "(":
+                depth = 0
+                while i < n:
+                    if s[i] == "(":
+                        depth += 1
+                    elif s[i] == ")":
+                        depth -= 1
+                        if depth == 0:
+                            i += 1
+                            break
+                    i += 1
+            tokens.append(("name", s[start:i]))
+    return tokens
+
+
+def _reduce(operands: list[KernelNode], ops: list[str]) -> None:
+    while ops and ops[-1] != "(":
+        op = ops.pop()
+        right = operands.pop()
+        left = operands.pop()
+        operands.append(KernelNode(op=op, left=left, right=right))
+    if ops:
+        ops.pop()
+
+
+# Cached trees are shared between callers; KernelNode is frozen for that reason.
+@lru_cache(maxsize=4096)
+def _parse_expr(s: str) -> KernelNode:
+    operands: list[KernelNode] = []
+    ops: list[str] = []
+    expect_operand = True
+    for kind, value in _tokenize(s):
+        if kind == "name":
+            operands.append(KernelNode(name=value))
+            expect_operand = False
+            continue
+        if kind == "(":
+            ops.append(value)
+            continue
+        if expect_operand:
+            operands.append(KernelNode(name="X"))
+        if kind == ")":
+            _reduce(operands, ops)
+            expect_operand = False
+        else:
+            ops.append(value)
+            expect_operand = True
+    if expect_operand and operands:
+        operands.append(KernelNode(name="X"))
+    while ops:
+        _reduce(operands, ops)
+    return operands[0] if operands else KernelNode(name="?")
 
 
 def parse_kernel_expr(s: str) -> KernelNode:
-    clean = _strip_highlight(s)
-    node, _ = _parse_expr(clean, 0)
-    return node
+    return _parse_expr(_strip_highlight(s))
 
 
 def parse_log(path: str) -> List[Dict]:
@@ -130,7 +158,7 @@ def _path_to_tuple(s: str) -> Tuple[str, ...]:
     return tuple(s)
 
 
-def visualize_log_run(log_path: str, out_dir: str) -> None:
+def visualize_log_run(log_path: str, out_dir: str, *, emit_before_after: bool = False) -> None:
     rounds = parse_log(log_path)
     os.makedirs(out_dir, exist_ok=True)
 
@@ -141,6 +169,7 @@ def visualize_log_run(log_path: str, out_dir: str) -> None:
         y_pad = (y_max - y_min) * 0.1 if y_max > y_min else 1.0
         y_limits = (y_min - y_pad, y_max + y_pad)
 
+        batch = DotBatch()
         init_kernel = parse_kernel_expr(r["init"])
         chain_kernels = [init_kernel]
         chain_scores = [None]
@@ -148,10 +177,10 @@ def visualize_log_run(log_path: str, out_dir: str) -> None:
             init_kernel,
             title=f"Round {r_idx} init",
             save_path=os.path.join(out_dir, f"round_{r_idx:02d}_init.png"),
+            batch=batch,
         )
 
         frame_scores: list[float] = []
-        frames: list[Image.Image] = []
         mutation_paths: list[str] = []
 
         for st in steps_sorted:
@@ -163,22 +192,25 @@ def visualize_log_run(log_path: str, out_dir: str) -> None:
             after_k = parse_kernel_expr(st["after"])
 
             prefix = f"round_{r_idx:02d}_step_{idx:03d}_{status}"
-            render_kernel_graph(
-                before_k,
-                highlight_paths={sever_path: "#ff6666"},
-                base_fillcolor="#ffffff",
-                score=log_alpha,
-                title=f"Round {r_idx} step {idx:03d} before",
-                save_path=os.path.join(out_dir, f"{prefix}_before.png"),
-            )
-            render_kernel_graph(
-                after_k,
-                highlight_paths={sever_path: "#66cc66"},
-                base_fillcolor="#ffffff",
-                score=log_alpha,
-                title=f"Round {r_idx} step {idx:03d} after",
-                save_path=os.path.join(out_dir, f"{prefix}_after.png"),
-            )
+            if emit_before_after:
+                render_kernel_graph(
+                    before_k,
+                    highlight_paths={sever_path: "#ff6666"},
+                    base_fillcolor="#ffffff",
+                    score=log_alpha,
+                    title=f"Round {r_idx} step {idx:03d} before",
+                    save_path=os.path.join(out_dir, f"{prefix}_before.png"),
+                    batch=batch,
+                )
+                render_kernel_graph(
+                    after_k,
+                    highlight_paths={sever_path: "#66cc66"},
+                    base_fillcolor="#ffffff",
+                    score=log_alpha,
+                    title=f"Round {r_idx} step {idx:03d} after",
+                    save_path=os.path.join(out_dir, f"{prefix}_after.png"),
+                    batch=batch,
+                )
 
             render_kernel_mutation(
                 before_k,
@@ -187,6 +219,7 @@ def visualize_log_run(log_path: str, out_dir: str) -> None:
                 score=log_alpha,
                 title=f"Round {r_idx} step {idx:03d} mutation",
                 save_path=os.path.join(out_dir, f"{prefix}_mutation.png"),
+                batch=batch,
             )
             mutation_paths.append(os.path.join(out_dir, f"{prefix}_mutation.png"))
             frame_scores.append(log_alpha)
@@ -201,46 +234,75 @@ def visualize_log_run(log_path: str, out_dir: str) -> None:
                 chain_scores,
                 title=f"Round {r_idx} chain (first {len(chain_kernels)} steps)",
                 save_path=os.path.join(out_dir, f"round_{r_idx:02d}_chain_5.png"),
+                batch=batch,
             )
+        batch.flush()
 
         if mutation_paths:
-            mutation_imgs = [Image.open(p).convert("RGBA") for p in mutation_paths]
-            max_mut_w = max(img.width for img in mutation_imgs)
-            max_mut_h = max(img.height for img in mutation_imgs)
-
-            for i, mut_img in enumerate(mutation_imgs):
-                mut_img = _pad_to_size(mut_img, max_mut_w, max_mut_h)
-                score_img = _render_score_plot(
-                    frame_scores[: i + 1],
-                    title="Score by step",
-                    total_steps=len(steps_sorted),
-                    y_limits=y_limits,
-                )
-                frame = _stack_images_vertically(mut_img, score_img)
-                frames.append(frame)
-
-        if frames:
-            max_w = max(img.width for img in frames)
-            max_h = max(img.height for img in frames)
-            frames = [_pad_to_size(img, max_w, max_h) for img in frames]
+            sizes: list[tuple[int, int]] = []
+            for p in mutation_paths:
+                with Image.open(p) as im:
+                    sizes.append(im.size)
+            mut_size = (max(w for w, _ in sizes), max(h for _, h in sizes))
             gif_path = os.path.join(out_dir, f"round_{r_idx:02d}_mutation.gif")
-            frames[0].save(
+
+            fig = Figure(figsize=(6, 2), dpi=150)
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            frames = _iter_frames(
+                ax,
+                mutation_paths,
+                frame_scores,
+                mut_size=mut_size,
+                total_steps=len(steps_sorted),
+                y_limits=y_limits,
+            )
+            first = next(frames).convert("RGB")
+            palette = first.convert("P", palette=Image.Palette.ADAPTIVE, colors=64)
+            paletted = (
+                f.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE) for f in frames
+            )
+            first.quantize(palette=palette, dither=Image.Dither.NONE).save(
                 gif_path,
                 save_all=True,
-                append_images=frames[1:],
+                append_images=paletted,
                 duration=900,
                 loop=0,
             )
 
 
+def _iter_frames(
+    ax: Axes,
+    mutation_paths: list[str],
+    frame_scores: list[float],
+    *,
+    mut_size: tuple[int, int],
+    total_steps: int,
+    y_limits: tuple[float, float],
+) -> Iterator[Image.Image]:
+    for i, path in enumerate(mutation_paths):
+        with Image.open(path) as raw:
+            mut_img = _pad_to_size(raw.convert("RGBA"), *mut_size)
+        score_img = _render_score_plot(
+            ax,
+            frame_scores[: i + 1],
+            title="Score by step",
+            total_steps=total_steps,
+            y_limits=y_limits,
+        )
+        yield _stack_images_vertically(mut_img, score_img)
+
+
 def _render_score_plot(
+    ax: Axes,
     scores: list[float],
     *,
     title: str,
     total_steps: int,
     y_limits: tuple[float, float],
 ) -> Image.Image:
-    fig, ax = plt.subplots(figsize=(6, 2))
+    fig = ax.figure
+    ax.cla()
     ax.plot(range(len(scores)), scores, color="#333333")
     ax.scatter([len(scores) - 1], [scores[-1]], color="#cc0000", s=30)
     ax.set_title(title, fontsize=10)
@@ -249,34 +311,40 @@ def _render_score_plot(
     ax.set_xlim(-0.5, max(1, total_steps - 0.5))
     ax.set_ylim(*y_limits)
     ax.grid(True, alpha=0.2)
-    fig.tight_layout()
+    # Labels and limits are fixed per round, so the first frame's layout holds.
+    if len(scores) == 1:
+        fig.tight_layout()
 
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=150)
-    plt.close(fig)
-    buf.seek(0)
-    return Image.open(buf).convert("RGBA")
+    fig.canvas.draw()
+    return Image.fromarray(np.array(fig.canvas.buffer_rgba()))
 
 
 def _stack_images_vertically(top: Image.Image, bottom_img: Image.Image) -> Image.Image:
     if bottom_img.width != top.width:
         new_height = int(bottom_img.height * (top.width / bottom_img.width))
         bottom_img = bottom_img.resize((top.width, new_height))
-    stacked = Image.new("RGBA", (top.width, top.height + bottom_img.height), (255, 255, 255, 255))
-    stacked.paste(top, (0, 0))
-    stacked.paste(bottom_img, (0, top.height))
-    return stacked
+    top, bottom_img = _as_rgba(top), _as_rgba(bottom_img)
+    stacked = np.empty((top.height + bottom_img.height, top.width, 4), dtype=np.uint8)
+    stacked[: top.height] = np.asarray(top)
+    stacked[top.height :] = np.asarray(bottom_img)
+    return Image.fromarray(stacked)
 
 
 def _pad_to_size(img: Image.Image, width: int, height: int) -> Image.Image:
     if img.width == width and img.height == height:
         return img
-    padded = Image.new("RGBA", (width, height), (255, 255, 255, 255))
+    if img.width > width or img.height > height:
+        raise ValueError(f"cannot pad {img.width}x{img.height} image to {width}x{height}")
+    img = _as_rgba(img)
+    padded = np.full((height, width, 4), 255, dtype=np.uint8)
     x = (width - img.width) // 2
     y = (height - img.height) // 2
-    padded.paste(img, (x, y))
-    return padded
+    padded[y : y + img.height, x : x + img.width] = np.asarray(img)
+    return Image.fromarray(padded)
+
 
+def _as_rgba(img: Image.Image) -> Image.Image:
+    return img if img.mode == "RGBA" else img.convert("RGBA")
 
 
 if __name__ == "__main__":